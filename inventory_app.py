@@ -1,22 +1,29 @@
 import os
 import io
-import base64
+import atexit
+import binascii
 import time
 import hashlib
+import shutil
 import threading
 import sqlite3
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from contextlib import contextmanager
 from datetime import datetime
-from typing import Optional, Tuple
+from functools import lru_cache
+from typing import TYPE_CHECKING, BinaryIO, Dict, Iterable, List, Optional, Tuple
 
 import pandas as pd
-from PIL import Image
-import requests
+from PIL import Image, ImageOps
 import streamlit as st
-from fpdf import FPDF
-from fpdf.enums import XPos, YPos
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import logging
 
+# requests and fpdf are imported lazily where used; they are not needed on every rerun
+if TYPE_CHECKING:
+    import requests
+    from fpdf import FPDF
+
 # =============================
 # App Constants & Paths
 # =============================
@@ -24,13 +31,20 @@ APP_TITLE = "BakeGuru Stock Manager"
 
 # Writable dir: /mount/data on Streamlit Cloud; current dir locally
 DATA_DIR = os.getenv("BAKEGURU_DATA_DIR", "/mount/data" if os.path.isdir("/mount/data") else ".")
-os.makedirs(DATA_DIR, exist_ok=True)
 
 DB_PATH = os.path.join(DATA_DIR, "bakeguru.db")
 IMG_DIR = os.path.join(DATA_DIR, "images")
-THUMB_DIR = os.path.join(IMG_DIR, "thumbs")
-os.makedirs(IMG_DIR, exist_ok=True)
-os.makedirs(THUMB_DIR, exist_ok=True)
+# with server.enableStaticServing the thumbs (a regenerable cache) live under the app's ./static folder,
+# so the grid can reference them by URL and the browser caches them instead of receiving base64 each rerun
+STATIC_THUMBS = bool(st.get_option("server.enableStaticServing"))
+if STATIC_THUMBS:
+    _APP_DIR = os.path.dirname(os.path.abspath(__file__))
+    THUMB_DIR = os.path.join(_APP_DIR, "static", "thumbs")
+    # in-flight writes stay outside the served folder (same filesystem, so os.replace is still atomic)
+    THUMB_TMP_DIR = os.path.join(_APP_DIR, ".thumbs_tmp")
+else:
+    THUMB_DIR = os.path.join(IMG_DIR, "thumbs")
+    THUMB_TMP_DIR = THUMB_DIR
 
 # =============================
 # SQLite Utilities (WAL + retry)
@@ -41,28 +55,113 @@ _db_lock = threading.Lock()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# resolved once at import rather than on every connect
+_ABS_DB = os.path.abspath(DB_PATH)
+_URI_RW = f"file:{_ABS_DB}?mode=rwc"
+_URI_RO = f"file:{_ABS_DB}?mode=ro"
+# NORMAL is crash-safe under WAL (a power cut may lose the last commits, never corrupt);
+# OFF skips fsync entirely for throwaway/single-user setups, FULL/EXTRA make every commit durable
+_SYNCHRONOUS = os.getenv("BAKEGURU_SQLITE_SYNC", "NORMAL").upper()
+if _SYNCHRONOUS not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+    _SYNCHRONOUS = "NORMAL"
+
+
+def _open_conn(readonly: bool) -> sqlite3.Connection:
+    uri = _URI_RO if readonly else _URI_RW
+    con = sqlite3.connect(uri, uri=True, timeout=30, isolation_level=None, check_same_thread=False)
+    # PRAGMAs are per-connection, so they only need to run once at open
+    con.execute("PRAGMA journal_mode=WAL;")
+    con.execute("PRAGMA busy_timeout=30000;")
+    con.execute(f"PRAGMA synchronous={_SYNCHRONOUS};")
+    con.execute("PRAGMA foreign_keys=ON;")   # ensure FK enforcement
+    con.execute("PRAGMA temp_store=MEMORY;")
+    con.execute("PRAGMA mmap_size=268435456;")   # 256 MB
+    con.execute("PRAGMA cache_size=-20000;")     # ~20 MB page cache
+    con.execute("PRAGMA wal_autocheckpoint=1000;")
+    con.execute("PRAGMA cache_spill=OFF;")       # keep dirty pages in cache until commit (small write batches)
+    return con
+
+
+class _ConnPool:
+    """Idle connections for one role (read-write or read-only), handed out to one thread at a time."""
+
+    def __init__(self, readonly: bool, max_idle: int = 4):
+        self.readonly = readonly
+        self.max_idle = max_idle
+        self._idle: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def acquire(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return _open_conn(self.readonly)
+
+    def release(self, con: sqlite3.Connection):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(con)
+                return
+        con.close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for con in idle:
+            con.close()
+
+
+# Streamlit re-executes this script (on a new thread) for every rerun, so module globals and
+# thread-locals do not persist; cache_resource keeps the pools for the life of the process.
+@st.cache_resource(show_spinner=False)
+def _conn_pools() -> Dict[str, _ConnPool]:
+    pools = {"rw": _ConnPool(readonly=False), "ro": _ConnPool(readonly=True)}
+    for pool in pools.values():
+        atexit.register(pool.close_all)
+    return pools
+
+
 @contextmanager
 def db_conn(readonly: bool = False):
-    abs_db = os.path.abspath(DB_PATH)
-    uri = f"file:{abs_db}?mode={'ro' if readonly else 'rwc'}"
-    con = sqlite3.connect(uri, uri=True, timeout=30, isolation_level=None, check_same_thread=False)
+    pool = _conn_pools()["ro" if readonly else "rw"]
+    con = pool.acquire()
     try:
-        con.execute("PRAGMA journal_mode=WAL;")
-        con.execute("PRAGMA busy_timeout=30000;")
-        con.execute("PRAGMA synchronous=NORMAL;")
-        con.execute("PRAGMA foreign_keys=ON;")   # ensure FK enforcement
         yield con
+    except Exception:
+        # connection goes back to the pool, so never leave a half-open transaction behind
+        if con.in_transaction:
+            con.rollback()
+        raise
     finally:
-        con.close()
+        pool.release(con)
 
 
-def exec_sql(sql: str, params: Tuple = ()):  # write with retry
+def exec_sql(sql: str, params: Tuple = ()):  # single-statement write with retry
     with _db_lock:
         for attempt in range(5):
             try:
                 with db_conn(False) as con:
-                    con.execute("BEGIN;")
+                    # autocommit: one statement is its own transaction (data_version is bumped by trigger)
                     con.execute(sql, params)
+                return
+            except sqlite3.OperationalError as e:
+                if "locked" in str(e).lower() and attempt < 4:
+                    time.sleep(0.25 * (attempt + 1))
+                    continue
+                raise
+
+
+def exec_many(sql: str, seq_of_params: Iterable[Tuple]):  # batched write, one transaction
+    rows = list(seq_of_params)
+    if not rows:
+        return
+    with _db_lock:
+        for attempt in range(5):
+            try:
+                with db_conn(False) as con:
+                    # take the write lock up front so contention surfaces here, not mid-batch
+                    con.execute("BEGIN IMMEDIATE;")
+                    con.executemany(sql, rows)
                     con.execute("COMMIT;")
                 return
             except sqlite3.OperationalError as e:
@@ -72,9 +171,21 @@ def exec_sql(sql: str, params: Tuple = ()):  # write with retry
                 raise
 
 
+def query_rows(sql: str, params: Tuple = ()) -> List[tuple]:
+    with db_conn(True) as con:
+        return con.execute(sql, params).fetchall()
+
+
 def query_df(sql: str, params: Tuple = ()) -> pd.DataFrame:
+    # plain cursor + from_records: skips read_sql_query's per-call overhead on these small result sets
     with db_conn(True) as con:
-        return pd.read_sql_query(sql, con, params=params)
+        cur = con.execute(sql, params)
+        cols = [d[0] for d in cur.description]
+        return pd.DataFrame.from_records(cur.fetchall(), columns=cols)
+
+
+def get_data_version() -> int:
+    return query_rows("SELECT value FROM _meta WHERE key = 'data_version'")[0][0]
 
 
 # =============================
@@ -109,51 +220,246 @@ CREATE TABLE IF NOT EXISTS quote_items (
     price REAL,
     FOREIGN KEY(quote_id) REFERENCES quotes(id)
 );
+
+CREATE TABLE IF NOT EXISTS _meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO _meta (key, value) VALUES ('data_version', 0);
+
+-- any product write bumps data_version inside its own transaction; readers use it as a cheap cache key
+CREATE TRIGGER IF NOT EXISTS trg_products_ins AFTER INSERT ON products
+BEGIN UPDATE _meta SET value = value + 1 WHERE key = 'data_version'; END;
+CREATE TRIGGER IF NOT EXISTS trg_products_upd AFTER UPDATE ON products
+BEGIN UPDATE _meta SET value = value + 1 WHERE key = 'data_version'; END;
+CREATE TRIGGER IF NOT EXISTS trg_products_del AFTER DELETE ON products
+BEGIN UPDATE _meta SET value = value + 1 WHERE key = 'data_version'; END;
+
+-- thumbnails already rendered to THUMB_DIR, so a render can check them all with one query
+CREATE TABLE IF NOT EXISTS thumbs (
+    thumb_id TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    src_mtime REAL,
+    etag TEXT,
+    last_modified TEXT
+);
+
+-- case-insensitive name order for the product list (load_products)
+CREATE INDEX IF NOT EXISTS idx_products_name_nocase ON products(name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS idx_products_cat ON products(category, subcategory);
+-- covering index for dashboard_totals: the aggregate scans this narrow index instead of full product rows
+CREATE INDEX IF NOT EXISTS idx_products_stock_price ON products(stock, price);
+CREATE INDEX IF NOT EXISTS idx_quote_items_qid ON quote_items(quote_id);
 """
 
-with db_conn(False) as con:
-    con.executescript(SCHEMA)
+@st.cache_resource(show_spinner=False)
+def _init_storage() -> bool:
+    # once per server process, not on every rerun: directories, schema, planner stats
+    os.makedirs(DATA_DIR, exist_ok=True)
+    os.makedirs(IMG_DIR, exist_ok=True)
+    os.makedirs(THUMB_DIR, exist_ok=True)
+    os.makedirs(THUMB_TMP_DIR, exist_ok=True)
+    with db_conn(False) as con:
+        con.executescript(SCHEMA)
+        con.execute("ANALYZE;")  # refresh planner stats so the indexes above get used
+    return True
+
+
+_init_storage()
+
+# hot write statements as constants: one identical string per call keeps sqlite3's statement cache warm
+UPDATE_PRODUCT_SQL = "UPDATE products SET name=?, category=?, subcategory=?, price=?, stock=?, image_url=? WHERE sku=?"
+INSERT_PRODUCT_SQL = """
+INSERT INTO products (sku, name, category, subcategory, price, image_url, stock)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(sku) DO UPDATE SET
+  name=excluded.name,
+  category=excluded.category,
+  subcategory=excluded.subcategory,
+  price=excluded.price,
+  image_url=excluded.image_url,
+  stock=excluded.stock
+"""
 
 # =============================
 # Image Helpers
 # =============================
 
-def _pil_to_data_url(img: Image.Image, ext: str = "JPEG") -> str:
-    buf = io.BytesIO()
-    img.save(buf, format=ext)
-    b64 = base64.b64encode(buf.getvalue()).decode("ascii")
-    mime = "image/jpeg" if ext.upper() == "JPEG" else f"image/{ext.lower()}"
+# shared HTTP session: keep-alive connection reuse + retry with backoff for image fetches.
+# cache_resource (not a module global) so the pool survives Streamlit reruns.
+@st.cache_resource(show_spinner=False)
+def _http() -> "requests.Session":
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    session.headers.update({"User-Agent": f"{APP_TITLE.replace(' ', '')}/1.0 (+thumbnail fetcher)"})
+    # most product images come from a handful of CDN hosts; size the pool for the thumb executor
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=64,
+        max_retries=Retry(total=3, backoff_factor=0.4, status_forcelist=[502, 503, 504]),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# cap on a downloaded source image; a 120px thumb never needs more, and it bounds per-fetch memory
+MAX_IMAGE_BYTES = 8 * 1024 * 1024
+# uploads are stored at most this size; nothing in the UI or the quote PDF ever draws them larger
+MAX_UPLOAD_DIM = (800, 800)
+
+# thumbs are WebP: roughly half the bytes of an equivalent JPEG, so half the base64 sent to the grid
+THUMB_MIME = "image/webp"
+
+
+def _bytes_to_data_url(raw, mime: str = THUMB_MIME) -> str:
+    # b2a_base64 takes any buffer (bytes / memoryview) and encodes in one pass, no newline to strip
+    b64 = binascii.b2a_base64(raw, newline=False).decode("ascii")
     return f"data:{mime};base64,{b64}"
 
 
+def _shortkey(b: bytes, n: int = 8) -> str:
+    # non-cryptographic cache keys: blake2b emits exactly n bytes (2n hex chars), no digest slicing
+    return hashlib.blake2b(b, digest_size=n).hexdigest()
+
+
+def _thumb_cache_path(key: str, src: str, kind: str) -> str:
+    src_hash = _shortkey(src.encode("utf-8"), 8)
+    return os.path.join(THUMB_DIR, f"{key}_{src_hash}_{kind}.webp")
+
+
+def _thumb_source(url: str) -> Tuple[str, str]:
+    """Classify an image reference by scheme (no filesystem access): (source, "urlthumb"|"pthumb")."""
+    if url.startswith(("http://", "https://")):
+        return url, "urlthumb"
+    return (url[7:] if url.startswith("file://") else url), "pthumb"
+
+
+def _record_thumbs(rows: List[Tuple[str, Optional[float], Optional[str], Optional[str]]]):
+    """Upsert (cache_path, src_mtime, etag, last_modified) rows into the thumbs table; best effort, never raises."""
+    try:
+        # one transaction for the whole batch, not one autocommit per row
+        exec_many(
+            "INSERT OR REPLACE INTO thumbs (thumb_id, path, src_mtime, etag, last_modified) VALUES (?, ?, ?, ?, ?)",
+            [(os.path.basename(p), p, m, etag, lm) for p, m, etag, lm in rows],
+        )
+    except Exception:
+        logger.exception("Failed to record %d thumb(s)", len(rows))
+
+
+def _lookup_thumbs(cache_paths: List[str]) -> Dict[str, Optional[float]]:
+    """Map thumb_id -> recorded src_mtime for every cache path that has a thumbs row."""
+    ids = list({os.path.basename(p) for p in cache_paths})
+    found: Dict[str, Optional[float]] = {}
+    for i in range(0, len(ids), 500):  # stay under SQLite's bound-parameter limit
+        chunk = ids[i:i + 500]
+        marks = ",".join("?" * len(chunk))
+        found.update(query_rows(f"SELECT thumb_id, src_mtime FROM thumbs WHERE thumb_id IN ({marks})", tuple(chunk)))
+    return found
+
+
+def _tmp_path(path: str) -> str:
+    return os.path.join(THUMB_TMP_DIR, f"{os.path.basename(path)}.{threading.get_ident()}.tmp")
+
+
+def _write_atomic(path: str, data: bytes):
+    # write-then-rename so concurrent readers never see a half-written file
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _save_thumb(img: Image.Image, cache_path: str) -> str:
+    """Encode `img` to WebP once, write it to `cache_path` and return the same bytes as a data URL."""
+    buf = io.BytesIO()
+    # method=2: about half the encode CPU of the default 4 for ~2% larger 120px thumbs
+    if img.mode != "RGB":  # convert() always copies, even to the same mode
+        img = img.convert("RGB")
+    img.save(buf, format="WEBP", quality=80, method=2)
+    data = buf.getbuffer()  # view over the encoder's buffer: shared by the file write and the data URL
+    durl = _bytes_to_data_url(data)
+    _write_atomic(cache_path, data)
+    # finished data URL next to the image (written after it, so it is the newer file);
+    # static mode serves the file by URL, and the sidecar would only be published alongside it
+    if not STATIC_THUMBS:
+        _write_atomic(cache_path + ".b64", durl.encode("ascii"))
+    return durl
+
+
+def _read_thumb_cache(cache_path: str) -> Optional[str]:
+    """Data URL for a cached thumb: the .b64 sidecar if it is current, else base64 of the image bytes.
+    An unreadable or empty image is removed so the caller re-renders it.
+    """
+    sidecar = cache_path + ".b64"
+    try:
+        # a sidecar older than its image (thumb re-rendered or aliased over) is ignored and rewritten
+        if os.path.getmtime(sidecar) >= os.path.getmtime(cache_path):
+            with open(sidecar, "r", encoding="ascii") as f:
+                durl = f.read()
+            if durl:
+                return durl
+    except OSError:
+        pass
+    try:
+        with open(cache_path, "rb") as f:
+            raw = f.read()
+        if raw:
+            durl = _bytes_to_data_url(raw)
+            if not STATIC_THUMBS:
+                try:
+                    _write_atomic(sidecar, durl.encode("ascii"))
+                except OSError:
+                    logger.warning("Failed to write thumb sidecar %s", sidecar)
+            return durl
+    except Exception:
+        logger.warning("Failed to read thumb cache %s", cache_path)
+    try:
+        os.remove(cache_path)
+    except Exception:
+        logger.warning("Failed to remove corrupted cache %s", cache_path)
+    return None
+
+
 # new: generate thumbnail from local file path
 def ensure_thumb_from_path(path: str, key: str, size=(120, 120), refresh: bool = False) -> Tuple[Optional[str], Optional[str]]:
     try:
         if not path or not os.path.exists(path):
             return None, None
-        url_hash = hashlib.sha1(path.encode("utf-8")).hexdigest()[:16]
-        thumb_name = f"{key}_{url_hash}_pthumb"
-        cache_path = os.path.join(THUMB_DIR, f"{thumb_name}.jpg")
-        if (not refresh) and os.path.exists(cache_path):
-            try:
-                with Image.open(cache_path) as im:
-                    im.load()
-                    return _pil_to_data_url(im, "JPEG"), cache_path
-            except Exception:
-                try:
-                    os.remove(cache_path)
-                except Exception:
-                    logger.warning("Failed to remove corrupted cache %s", cache_path)
+        cache_path = _thumb_cache_path(key, path, "pthumb")
+        # only a thumb at least as new as its source counts as a hit (uploads overwrite in place)
+        if (not refresh) and os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+            durl = _read_thumb_cache(cache_path)
+            if durl:
+                return durl, cache_path
+        src_mtime = os.path.getmtime(path)
         with Image.open(path) as im:
-            im.thumbnail(size)
-            im.convert("RGB").save(cache_path, format="JPEG", quality=85)
-        with Image.open(cache_path) as im2:
-            return _pil_to_data_url(im2, "JPEG"), cache_path
+            im.draft("RGB", size)  # JPEG: let libjpeg decode at reduced scale (no-op otherwise)
+            # draft + reducing_gap leave at most a ~2x residual, where BILINEAR matches LANCZOS visually
+            im.thumbnail(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+            durl = _save_thumb(im, cache_path)
+        _record_thumbs([(cache_path, src_mtime, None, None)])
+        return durl, cache_path
     except Exception as e:
         logger.exception("ensure_thumb_from_path failed for %s: %s", path, e)
         return None, None
 
 
+def _webp_is_lossless(data) -> bool:
+    """True if a WebP file's image chunk is VP8L (lossless) rather than VP8 (lossy)."""
+    pos = 12  # past "RIFF" <size> "WEBP"
+    while pos + 8 <= len(data):
+        fourcc = bytes(data[pos:pos + 4])
+        if fourcc in (b"VP8L", b"VP8 "):
+            return fourcc == b"VP8L"
+        size = int.from_bytes(data[pos + 4:pos + 8], "little")
+        pos += 8 + size + (size & 1)  # chunks are padded to an even length
+    return False
+
+
 # new: save uploaded image to IMG_DIR and return saved path
 def save_uploaded_image(upload, sku: str) -> Optional[str]:
     try:
@@ -168,10 +474,31 @@ def save_uploaded_image(upload, sku: str) -> Optional[str]:
         if len(buf) > 5 * 1024 * 1024:  # 5 MB limit
             logger.warning("Uploaded file too large: %s bytes", len(buf))
             return None
-        safe = "".join(c for c in (sku or "") if c.isalnum() or c in ("-","_")) or hashlib.sha1(upload.name.encode()).hexdigest()[:8]
+        safe = "".join(c for c in (sku or "") if c.isalnum() or c in ("-","_")) or _shortkey(upload.name.encode(), 4)
         fpath = os.path.join(IMG_DIR, f"{safe}{ext}")
-        with open(fpath, "wb") as f:
-            f.write(buf)
+        # downscale once at ingest so every later thumb/PDF read is small; re-encode (dropping EXIF)
+        # only when that changes the pixels, so small uploads keep their original quality
+        with Image.open(io.BytesIO(buf)) as im:
+            oversized = im.width > MAX_UPLOAD_DIM[0] or im.height > MAX_UPLOAD_DIM[1]
+            rotated = im.getexif().get(0x0112, 1) != 1  # EXIF Orientation
+            if not (oversized or rotated):
+                with open(fpath, "wb") as f:
+                    f.write(buf)
+                return fpath
+            im.draft("RGB", MAX_UPLOAD_DIM)  # JPEG: scaled IDCT at decode, never below the target size
+            im = ImageOps.exif_transpose(im)  # bake in the orientation before the EXIF tag is dropped
+            im.thumbnail(MAX_UPLOAD_DIM, Image.Resampling.LANCZOS)
+            if ext in (".jpg", ".jpeg"):
+                if im.mode != "RGB":
+                    im = im.convert("RGB")
+                im.save(fpath, "JPEG", quality=85, optimize=True)
+            elif ext == ".webp":
+                if _webp_is_lossless(buf):
+                    im.save(fpath, "WEBP", lossless=True)
+                else:
+                    im.save(fpath, "WEBP", quality=85)
+            else:
+                im.save(fpath)  # PNG: lossless anyway
         return fpath
     except Exception as e:
         logger.exception("save_uploaded_image failed: %s", e)
@@ -189,70 +516,379 @@ def ensure_thumb_from_url(url: str, key: str, size=(120, 120), refresh: bool = F
         if os.path.exists(url):
             return ensure_thumb_from_path(url, key, size=size, refresh=refresh)
 
-        url_hash = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
-        thumb_name = f"{key}_{url_hash}_urlthumb"
-        cache_path = os.path.join(THUMB_DIR, f"{thumb_name}.jpg")
+        cache_path = _thumb_cache_path(key, url, "urlthumb")
 
         if (not refresh) and os.path.exists(cache_path):
-            try:
-                with Image.open(cache_path) as im:
-                    im.load()
-                    return _pil_to_data_url(im, "JPEG"), cache_path
-            except Exception:
-                try:
-                    os.remove(cache_path)
-                except Exception:
-                    logger.warning("Failed to remove corrupted cache %s", cache_path)
-
-        last_err = None
-        for attempt in range(3):
-            try:
-                r = requests.get(url, timeout=10)
-                r.raise_for_status()
-                with Image.open(io.BytesIO(r.content)) as im:
-                    im.thumbnail(size)
-                    im.convert("RGB").save(cache_path, format="JPEG", quality=85)
-                with Image.open(cache_path) as im2:
-                    return _pil_to_data_url(im2, "JPEG"), cache_path
-            except Exception as e:
-                last_err = e
-                logger.debug("Attempt %d failed for %s: %s", attempt + 1, url, e)
-                time.sleep(0.4 * (attempt + 1))
-        raise last_err if last_err else RuntimeError("unknown fetch error")
+            durl = _read_thumb_cache(cache_path)
+            if durl:
+                return durl, cache_path
+
+        # on refresh, revalidate against the CDN instead of re-downloading an unchanged image
+        headers = {}
+        if os.path.exists(cache_path):
+            for etag, last_modified in query_rows(
+                "SELECT etag, last_modified FROM thumbs WHERE thumb_id = ?", (os.path.basename(cache_path),)
+            ):
+                if etag:
+                    headers["If-None-Match"] = etag
+                if last_modified:
+                    headers["If-Modified-Since"] = last_modified
+
+        # retries/backoff are handled by the session's urllib3 Retry policy
+        with _http().get(url, headers=headers, timeout=(3, 10), stream=True) as r:
+            r.raise_for_status()
+            if r.status_code == 304:
+                with open(cache_path, "rb") as f:
+                    return _bytes_to_data_url(f.read()), cache_path
+            # refuse oversized assets before (Content-Length) or while (capped read) downloading them
+            if int(r.headers.get("Content-Length") or 0) > MAX_IMAGE_BYTES:
+                raise ValueError(f"image larger than {MAX_IMAGE_BYTES} bytes")
+            r.raw.decode_content = True  # undo gzip/deflate transfer encoding, if any
+            body = r.raw.read(MAX_IMAGE_BYTES + 1)
+            if len(body) > MAX_IMAGE_BYTES:
+                raise ValueError(f"image larger than {MAX_IMAGE_BYTES} bytes")
+            validators = (r.headers.get("ETag"), r.headers.get("Last-Modified"))
+        with Image.open(io.BytesIO(body)) as im:  # BytesIO adopts the bytes without another copy
+            im.draft("RGB", size)
+            im.thumbnail(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+            durl = _save_thumb(im, cache_path)
+        _record_thumbs([(cache_path, None, *validators)])
+        return durl, cache_path
     except Exception as e:
         logger.exception("ensure_thumb_from_url failed for %s: %s", url, e)
         return None, None
 
 
+def thumb_key(sku: Optional[str], url: Optional[str], idx) -> str:
+    """Thumb cache key for a row: its SKU, else a short hash of the image URL, else the row position."""
+    sku = sku.strip() if isinstance(sku, str) else ""
+    if sku:
+        return sku
+    if isinstance(url, str) and url:
+        return _shortkey(url.encode("utf-8"), 5)
+    return f"row{idx}"
+
+
+def thumb_keys(skus: pd.Series, urls: pd.Series) -> List[str]:
+    """thumb_key over aligned sku / image_url columns; only blank-SKU rows pay for a hash."""
+    keys = skus.fillna("").astype(str).str.strip().tolist()  # SKU is a TEXT column: str or missing
+    return [key or thumb_key(None, url, i) for key, url, i in zip(keys, urls.tolist(), urls.index)]
+
+
+@st.cache_resource(show_spinner=False)
+def _thumb_executor() -> ThreadPoolExecutor:
+    # shared across reruns/sessions; fetch + decode release the GIL for most of their time
+    return ThreadPoolExecutor(max_workers=16, thread_name_prefix="thumbs")
+
+
+@st.cache_resource(show_spinner=False)
+def _thumb_bg_executor() -> ThreadPoolExecutor:
+    # background (start_thumbs) renders get their own pool, so a cold catalog never queues
+    # the blocking Quote Builder / PDF renders behind its backlog
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="thumbs-bg")
+
+
+class _ThumbUnavailable(Exception):
+    """Raised by the memoized thumb helpers on failure, so st.cache_data stores nothing and the next run retries."""
+
+
+def _thumb_or_raise(res: Tuple[Optional[str], Optional[str]], src: str) -> Tuple[Optional[str], Optional[str]]:
+    if res[1] is None:
+        raise _ThumbUnavailable(src)
+    return res
+
+
+# in-process memo on top of the on-disk thumb cache: warm reruns skip PIL + base64 entirely
+@st.cache_data(show_spinner=False, max_entries=4096)
+def cached_thumb_from_path(path: str, mtime: float, key: str, size=(120, 120)) -> Tuple[Optional[str], Optional[str]]:
+    # mtime is only part of the cache key, so edits to the source file invalidate the entry
+    return _thumb_or_raise(ensure_thumb_from_path(path, key, size=size), path)
+
+
+@st.cache_data(show_spinner=False, max_entries=4096)
+def cached_thumb_from_url(url: str, key: str, size=(120, 120)) -> Tuple[Optional[str], Optional[str]]:
+    return _thumb_or_raise(ensure_thumb_from_url(url, key, size=size), url)
+
+
+@st.cache_data(show_spinner=False, max_entries=4096)
+def cached_thumb_data_url(cache_path: str, mtime: float) -> str:
+    """Data URL of a thumb already on disk; never renders. Raises OSError if the file is gone or unreadable."""
+    # mtime is only part of the cache key: a thumb re-rendered in place gets a fresh entry
+    durl = _read_thumb_cache(cache_path)
+    if durl is None:
+        raise FileNotFoundError(cache_path)
+    return durl
+
+
+def clear_thumb_memo():
+    cached_thumb_from_path.clear()
+    cached_thumb_from_url.clear()
+    cached_thumb_data_url.clear()
+
+
+def _resolve_thumb(key: str, url: str, refresh: bool = False) -> Tuple[Optional[str], Optional[str]]:
+    if not url:
+        return None, None
+    src, kind = _thumb_source(url)
+    if kind == "pthumb":
+        if not os.path.exists(src):
+            return None, None
+        if refresh:
+            return ensure_thumb_from_path(src, key, refresh=True)
+        try:
+            res = cached_thumb_from_path(src, os.path.getmtime(src), key)
+        except _ThumbUnavailable:
+            return None, None
+        # the memo can outlive its file (thumb dir wiped, corrupt file removed): render it again
+        return res if os.path.exists(res[1]) else ensure_thumb_from_path(src, key)
+    if refresh:
+        return ensure_thumb_from_url(url, key, refresh=True)
+    try:
+        res = cached_thumb_from_url(url, key)
+    except _ThumbUnavailable:
+        return None, None
+    return res if os.path.exists(res[1]) else ensure_thumb_from_url(url, key)
+
+
+def _cached_thumb_paths(tasks: List[Tuple[str, str]]) -> List[Optional[str]]:
+    """For each (key, url) task, the path of an up-to-date thumb already on disk, or None on a miss.
+    One batched thumbs-table query answers freshness; a recorded thumb whose file is gone (THUMB_DIR wiped,
+    static dir lost on redeploy, corrupt file removed) is a miss, and its row is rewritten when it re-renders.
+    """
+    srcs = [_thumb_source(url) for _, url in tasks]
+    paths = [_thumb_cache_path(key, src, kind) for (key, _), (src, kind) in zip(tasks, srcs)]
+    known = _lookup_thumbs(paths)
+    out: List[Optional[str]] = []
+    backfill = []
+    for cache_path, (src, kind) in zip(paths, srcs):
+        tid = os.path.basename(cache_path)
+        if tid in known:
+            # a local source edited after its thumb was rendered is a miss
+            fresh = os.path.exists(cache_path) and (
+                kind == "urlthumb" or (os.path.exists(src) and os.path.getmtime(src) <= (known[tid] or 0))
+            )
+            out.append(cache_path if fresh else None)
+            continue
+        # no record yet (e.g. thumbs rendered before the table existed): check the disk once and backfill
+        if os.path.exists(cache_path) and (
+            kind == "urlthumb" or (os.path.exists(src) and os.path.getmtime(cache_path) >= os.path.getmtime(src))
+        ):
+            backfill.append((cache_path, os.path.getmtime(src) if kind == "pthumb" else None, None, None))
+            out.append(cache_path)
+        else:
+            out.append(None)
+    if backfill:
+        _record_thumbs(backfill)
+    return out
+
+
+def _alias_thumbs(thumb_path: str, aliases: List[Tuple[str, str]]) -> List[Optional[str]]:
+    """Copy one rendered thumb to the cache paths of other (key, url) rows sharing its source."""
+    out: List[Optional[str]] = []
+    rows = []
+    for key, url in aliases:
+        src, kind = _thumb_source(url)
+        cache_path = _thumb_cache_path(key, src, kind)
+        try:
+            tmp_path = _tmp_path(cache_path)
+            shutil.copyfile(thumb_path, tmp_path)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            logger.warning("Failed to alias thumb %s -> %s", thumb_path, cache_path)
+            out.append(None)
+            continue
+        rows.append((cache_path, os.path.getmtime(src) if kind == "pthumb" else None, None, None))
+        out.append(cache_path)
+    if rows:
+        _record_thumbs(rows)
+    return out
+
+
+def _static_thumb_url(cache_path: str) -> str:
+    # mtime in the query string busts the browser cache when a thumb is re-rendered in place
+    return f"app/static/thumbs/{os.path.basename(cache_path)}?v={int(os.path.getmtime(cache_path))}"
+
+
+# a background render that failed (dead link, CDN error) is not resubmitted for this long
+THUMB_RETRY_AFTER = 60.0
+
+
+@st.cache_resource(show_spinner=False)
+def _thumb_jobs() -> Tuple[threading.RLock, Dict[tuple, Future], Dict[tuple, float]]:
+    """(lock, in-flight renders, job -> monotonic time it failed), shared across reruns and sessions.
+    Jobs leave the in-flight map as they finish, so neither map outlives the renders it tracks.
+    """
+    # reentrant: a job that is already done runs its done-callback in the submitting thread, under the lock
+    return threading.RLock(), {}, {}
+
+
+def _source_stamp(url: str) -> Optional[float]:
+    # local sources carry their mtime in the job key, so a re-uploaded image is a new job
+    src, kind = _thumb_source(url)
+    return os.path.getmtime(src) if kind == "pthumb" and os.path.exists(src) else None
+
+
+def _render_group(url: str, keys: List[str], refresh: bool) -> List[Tuple[Optional[str], Optional[str]]]:
+    """Render one source for every key sharing it: the first key renders, the rest get copies."""
+    durl, path = _resolve_thumb(keys[0], url, refresh)
+    if len(keys) == 1 or not path:
+        return [(durl, path)] * len(keys)
+    aliased = _alias_thumbs(path, [(key, url) for key in keys[1:]])
+    return [(durl, path)] + [(durl, alias or path) for alias in aliased]
+
+
+def _dispatch_thumbs(tasks: List[Tuple[str, str]], refresh: bool, data_urls: bool, wait: bool):
+    if refresh:
+        clear_thumb_memo()
+    ex = _thumb_executor() if wait else _thumb_bg_executor()
+    ctx = get_script_run_ctx()
+
+    def run(url: str, keys: List[str]):
+        # pool threads call st.cache_data functions, so give them the session's script context
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return _render_group(url, keys, refresh)
+
+    # rows whose thumb is already on disk are cheap: read them inline, pool only the misses.
+    # nothing here renders on the script thread: a hit that turns out unreadable becomes a miss
+    results: List = [(None, None)] * len(tasks)
+    live = [(idx, key, url) for idx, (key, url) in enumerate(tasks) if isinstance(url, str) and url]  # drop None/NaN
+    cached = [None] * len(live) if refresh else _cached_thumb_paths([(key, url) for _, key, url in live])
+    # variants often share one image: fetch/decode each distinct source once, copy it to the other keys
+    misses: Dict[str, List[Tuple[int, str]]] = {}
+    for (idx, key, url), cache_path in zip(live, cached):
+        if cache_path and (STATIC_THUMBS or not data_urls) and os.path.exists(cache_path):
+            results[idx] = (_static_thumb_url(cache_path) if data_urls else None, cache_path)
+        else:
+            if cache_path:
+                try:
+                    results[idx] = (cached_thumb_data_url(cache_path, os.path.getmtime(cache_path)), cache_path)
+                    continue
+                except OSError:
+                    pass
+            misses.setdefault(url, []).append((idx, key))
+
+    pending: List[Future] = []
+    if wait:
+        futures = {ex.submit(run, url, [key for _, key in rows]): url for url, rows in misses.items()}
+        for fut in as_completed(futures):
+            for (idx, _), res in zip(misses[futures[fut]], fut.result()):
+                results[idx] = res
+    else:
+        lock, jobs, failed = _thumb_jobs()
+
+        def finish(job: tuple, fut: Future):
+            # successes are picked up from disk by the next run; failures are parked for THUMB_RETRY_AFTER
+            with lock:
+                jobs.pop(job, None)
+                if fut.exception() is not None or not fut.result()[0][1]:
+                    failed[job] = time.monotonic()
+
+        with lock:
+            now = time.monotonic()
+            for job in [job for job, at in failed.items() if now - at >= THUMB_RETRY_AFTER]:
+                del failed[job]
+            for url, rows in misses.items():
+                job = (url, tuple(key for _, key in rows), _source_stamp(url))
+                if job in failed:
+                    continue  # row keeps its (None, None) placeholder until the retry window passes
+                fut = jobs.get(job)
+                if fut is None:
+                    fut = jobs[job] = ex.submit(run, url, list(job[1]))
+                    fut.add_done_callback(lambda f, job=job: finish(job, f))
+                if not fut.done():
+                    pending.append(fut)  # row keeps its (None, None) placeholder for now
+                    continue
+                # done, but its done-callback has not run yet: collect the results here
+                jobs.pop(job, None)
+                if fut.exception() is None:
+                    for (idx, _), res in zip(rows, fut.result()):
+                        results[idx] = res
+    if STATIC_THUMBS and data_urls:
+        results = [(_static_thumb_url(path), path) if path else (None, None) for _, path in results]
+    return results, pending
+
+
+def build_thumbs(tasks: List[Tuple[str, str]], refresh: bool = False, data_urls: bool = True) -> List[Tuple[Optional[str], Optional[str]]]:
+    """Resolve (key, url) pairs to (data_url, thumb_path) in parallel, preserving input order.
+    With data_urls=False (PDF / cart prep) disk hits return (None, thumb_path) without reading the file.
+    With STATIC_THUMBS the first element is the thumb's static URL rather than a data URL.
+    """
+    return _dispatch_thumbs(tasks, refresh, data_urls, wait=True)[0]
+
+
+def start_thumbs(tasks: List[Tuple[str, str]]) -> Tuple[List[Tuple[Optional[str], Optional[str]]], List[Future]]:
+    """Non-blocking build_thumbs: cache hits now, (None, None) for rows still rendering in the background.
+    Returns the results plus the pending futures; a later run picks the finished renders up.
+    """
+    return _dispatch_thumbs(tasks, refresh=False, data_urls=True, wait=False)
+
+
+@st.fragment(run_every=0.75)
+def _await_thumbs(pending: List[Future]):
+    left = sum(not fut.done() for fut in pending)
+    if not left:
+        st.rerun()  # whole app, so the grid picks the finished thumbs up
+    st.caption(f"⏳ Rendering {left} thumbnail(s)…")
+
+
 # =============================
 # PDF Quote Builder
 # =============================
-class QuotePDF(FPDF):
-    def header(self):
-        self.set_font("helvetica", "B", 16)
-        self.cell(0, 10, "BakeGuru Quote", align="C", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
-        self.ln(2)
-
-    def footer(self):
-        self.set_y(-15)
-        self.set_font("helvetica", "I", 8)
-        self.cell(0, 10, f"Page {self.page_no()}", align="C")
-
-
-def _pdf_output_bytes(pdf: FPDF) -> bytes:
-    out = pdf.output(dest="S")
-    if isinstance(out, bytearray):
-        return bytes(out)
-    if isinstance(out, str):
-        return out.encode("latin1")
-    return out
+@lru_cache(maxsize=None)
+def _quote_pdf_class():
+    from fpdf import FPDF
+    from fpdf.enums import XPos, YPos
+
+    class QuotePDF(FPDF):
+        def header(self):
+            self.set_font("helvetica", "B", 16)
+            self.cell(0, 10, "BakeGuru Quote", align="C", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+            self.ln(2)
+
+        def footer(self):
+            self.set_y(-15)
+            self.set_font("helvetica", "I", 8)
+            self.cell(0, 10, f"Page {self.page_no()}", align="C")
+
+    return QuotePDF
+
+
+PDF_ITEM_COLUMNS = ["sku", "name", "qty", "price", "image_url", "thumb_path"]
 
 
 def render_quote_pdf(meta: dict, items: pd.DataFrame) -> bytes:
     """Build a compact quote PDF with image first in each row.
     Expects `items` to have columns: sku, name, qty, price, image_url (optional), thumb_path (optional).
     """
-    pdf = QuotePDF()
+    # fpdf2 >= 2.7 returns the finished document as a bytearray: no dest="S" / latin1 round-trip
+    return bytes(_build_quote_pdf(meta, items).output())
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def _cached_quote_pdf(meta_items: Tuple[Tuple[str, str], ...], items: pd.DataFrame, thumb_stamps: tuple) -> bytes:
+    # thumb_stamps is only part of the cache key (see quote_pdf_bytes)
+    return render_quote_pdf(dict(meta_items), items)
+
+
+def quote_pdf_bytes(meta: dict, items: pd.DataFrame) -> bytes:
+    """render_quote_pdf memoized on (meta, items): re-generating an unchanged quote is a cache hit."""
+    # thumb mtimes join the key so a thumb re-rendered at the same path is not served from a stale PDF
+    stamps = tuple(
+        os.path.getmtime(p) if isinstance(p, str) and os.path.exists(p) else None
+        for p in items.get("thumb_path", ())
+    )
+    return _cached_quote_pdf(tuple(sorted(meta.items())), items, stamps)
+
+
+def render_quote_pdf_to(stream: BinaryIO, meta: dict, items: pd.DataFrame) -> None:
+    """Like render_quote_pdf, but writes the document straight into a binary file-like `stream`."""
+    _build_quote_pdf(meta, items).output(stream)
+
+
+def _build_quote_pdf(meta: dict, items: pd.DataFrame) -> "FPDF":
+    from fpdf.enums import XPos, YPos
+
+    pdf = _quote_pdf_class()()
     pdf.set_auto_page_break(auto=True, margin=12)
     pdf.add_page()
 
@@ -274,49 +910,78 @@ def render_quote_pdf(meta: dict, items: pd.DataFrame) -> bytes:
     pdf.cell(col_w["total"], 8, "Total", border=1, align="R", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
 
     pdf.set_font("helvetica", size=9)
-    total = 0.0
-
-    def row_height_for(name: str) -> int:
-        lines = max(1, (len(name) // 40) + 1)
-        return 20 if lines > 1 else 14
-
-    for _, r in items.iterrows():
-        qty = int(r.get("qty", 0) or 0)
-        price = float(r.get("price", 0) or 0)
-        line_total = qty * price
-        total += line_total
-
-        rh = row_height_for(str(r.get("name", "")))
-        y0 = pdf.get_y(); x0 = pdf.get_x()
-
-        # Image first
-        pdf.cell(col_w["img"], rh, "", border=1)
-        img_path = r.get("thumb_path")
-        if not img_path and r.get("image_url"):
-            key = r.get("sku") or hashlib.sha1(str(r.get("image_url")).encode()).hexdigest()[:10]
-            _, img_path = ensure_thumb_from_url(str(r.get("image_url")), f"{key}_pdf")
-        if img_path:
-            try:
-                pdf.image(img_path, x=x0 + 1.5, y=y0 + 1.5, w=col_w["img"] - 3)
-            except Exception:
-                pass
-        pdf.set_xy(x0 + col_w["img"], y0)
-
-        # Rest of row
-        pdf.cell(col_w["sku"], rh, str(r.get("sku", ""))[:14], border=1)
-        x1 = pdf.get_x(); y1 = pdf.get_y()
-        pdf.multi_cell(col_w["name"], 6, str(r.get("name", "")), border=1)
-        pdf.set_xy(x1 + col_w["name"], y0)
-        pdf.cell(col_w["qty"], rh, str(qty), border=1, align="R")
-        pdf.cell(col_w["price"], rh, f"{price:.2f}", border=1, align="R")
-        pdf.cell(col_w["total"], rh, f"{line_total:.2f}", border=1, align="R", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+
+    # stable column set with None for missing values, so rows can be read as plain namedtuples
+    items = items.reindex(columns=PDF_ITEM_COLUMNS)
+    qty = pd.to_numeric(items["qty"], errors="coerce").fillna(0).astype(int)
+    price = pd.to_numeric(items["price"], errors="coerce").fillna(0.0)
+    items = items.astype(object)
+    items = items.where(items.notna(), None)
+    # money math in one vectorized pass rather than a Python accumulator in the layout loop
+    items["qty"] = qty
+    items["price"] = price
+    items["line_total"] = qty * price
+    total = float(items["line_total"].sum())
+
+    # fetch missing thumbnails for all rows up front, in parallel, instead of one round-trip per row
+    need = items["thumb_path"].isna() & items["image_url"].notna()
+    if need.any():
+        urls = items.loc[need, "image_url"].astype(str)
+        tasks = [(f"{key}_pdf", url) for key, url in zip(thumb_keys(items.loc[need, "sku"], urls), urls)]
+        items.loc[need, "thumb_path"] = [path for _, path in build_thumbs(tasks, data_urls=False)]
+
+    # cell text and row heights for every row in vectorized passes, so the layout loop only draws
+    names = items["name"].fillna("").astype(str)
+    rows = zip(
+        items["sku"].fillna("").astype(str).str.slice(0, 14),
+        names,
+        names.str.len().ge(40).map({True: 20, False: 14}),  # long names wrap onto a second line
+        qty.astype(str),
+        price.map("{:.2f}".format),
+        items["line_total"].map("{:.2f}".format),
+        items["thumb_path"],
+    )
+    # fpdf is pure Python: hoist the bound methods and column widths out of the loop
+    cell, multi_cell, image, set_xy = pdf.cell, pdf.multi_cell, pdf.image, pdf.set_xy
+    w_img, w_sku, w_name, w_qty, w_price, w_total = (col_w[k] for k in ("img", "sku", "name", "qty", "price", "total"))
+
+    # decode each distinct thumbnail once, even if several rows share it
+    img_cache: Dict[str, Image.Image] = {}
+    try:
+        for sku_s, name_s, rh, qty_s, price_s, total_s, img_path in rows:
+            y0 = pdf.get_y(); x0 = pdf.get_x()
+
+            # Image first
+            cell(w_img, rh, "", border=1)
+            if img_path:
+                try:
+                    img = img_cache.get(img_path)
+                    if img is None:
+                        img = img_cache[img_path] = Image.open(img_path)
+                        img.load()
+                    image(img, x=x0 + 1.5, y=y0 + 1.5, w=w_img - 3)
+                except Exception:
+                    pass
+            set_xy(x0 + w_img, y0)
+
+            # Rest of row
+            cell(w_sku, rh, sku_s, border=1)
+            x1 = pdf.get_x()
+            multi_cell(w_name, 6, name_s, border=1)
+            set_xy(x1 + w_name, y0)
+            cell(w_qty, rh, qty_s, border=1, align="R")
+            cell(w_price, rh, price_s, border=1, align="R")
+            cell(w_total, rh, total_s, border=1, align="R", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    finally:
+        for img in img_cache.values():
+            img.close()
 
     pdf.set_font("helvetica", "B", 11)
     pdf.cell(0, 10, f"Grand Total: {total:.2f}", align="R", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
     pdf.set_font("helvetica", "I", 9)
     pdf.cell(0, 7, "Prices are exclusive of taxes, unless specified.")
 
-    return _pdf_output_bytes(pdf)
+    return pdf
 
 # =============================
 # Streamlit UI
@@ -325,26 +990,68 @@ st.set_page_config(page_title=APP_TITLE, page_icon="📦", layout="wide")
 st.title(APP_TITLE)
 
 # ---- Draft Quote (session state) ----
+# draft lines keyed by SKU (name for SKU-less rows); adding an item bumps qty in place, no concat/groupby
+DRAFT_COLUMNS = ["sku", "name", "price", "qty", "image_url", "thumb_path"]
 if "draft_cart" not in st.session_state:
-    st.session_state["draft_cart"] = pd.DataFrame(columns=["sku","name","price","qty","image_url","thumb_path"])  # empty
+    st.session_state["draft_cart"] = {}
+
+
+def add_to_draft(cart: Dict[str, dict], rows: Iterable[tuple]):
+    """Merge (sku, name, price, image_url, thumb_path, qty) rows into `cart` in place."""
+    for sku, name, price, image_url, thumb_path, qty in rows:
+        line = cart.setdefault(
+            sku or name,
+            {"sku": sku, "name": name, "price": price, "qty": 0, "image_url": image_url, "thumb_path": thumb_path},
+        )
+        line["qty"] += int(qty) if pd.notna(qty) else 0
+
+
+def draft_frame(cart: Dict[str, dict]) -> pd.DataFrame:
+    return pd.DataFrame(list(cart.values()), columns=DRAFT_COLUMNS)
 
 # ---------- Dashboard ----------
 
+@st.cache_data(ttl=300, show_spinner=False)
+def load_products(version: int) -> pd.DataFrame:
+    # `version` is only a cache key (see get_data_version); any write invalidates the cached frame
+    return query_df("SELECT sku, name, category, subcategory, price, image_url, stock FROM products ORDER BY name COLLATE NOCASE")
+
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def products_by_name(version: int) -> Dict[str, List[tuple]]:
+    """name -> [(sku, name, price, image_url), ...]; read-only, shared across sessions like load_products."""
+    index: Dict[str, List[tuple]] = {}
+    for row in load_products(version)[["sku", "name", "price", "image_url"]].itertuples(index=False, name=None):
+        index.setdefault(row[1], []).append(row)
+    return index
+
+
+@st.cache_data(ttl=5, show_spinner=False)
+def dashboard_totals(version: int) -> Tuple[int, int, float]:
+    # one pass over products instead of three separate COUNT/SUM queries; three scalars need no DataFrame
+    n, s, v = query_rows("SELECT COUNT(*), COALESCE(SUM(stock),0), COALESCE(SUM(price*stock),0) FROM products")[0]
+    return int(n), int(s), float(v)
+
+
 def page_dashboard():
-    a = query_df("SELECT COUNT(*) as n FROM products")
-    b = query_df("SELECT SUM(stock) as s FROM products")
-    c = query_df("SELECT SUM(price*stock) as v FROM products")
+    n, s, v = dashboard_totals(get_data_version())
 
     c1, c2, c3 = st.columns(3)
-    c1.metric("Products", int(a.iloc[0,0] or 0))
-    c2.metric("Units in Stock", int(b.iloc[0,0] or 0))
-    c3.metric("Inventory Value", f"₹{(c.iloc[0,0] or 0):,.2f}")
+    c1.metric("Products", n)
+    c2.metric("Units in Stock", s)
+    c3.metric("Inventory Value", f"₹{v:,.2f}")
 
 
 # ---------- View Stock (select → Add to Draft) ----------
 
+def _editor_dirty(key: str) -> bool:
+    """True if the data_editor under `key` holds edits, ticks, added or deleted rows."""
+    state = st.session_state.get(key) or {}
+    return any(state.get(k) for k in ("edited_rows", "added_rows", "deleted_rows"))
+
+
 def page_view_stock():
-    df = query_df("SELECT sku, name, category, subcategory, price, image_url, stock FROM products ORDER BY name")
+    df = load_products(get_data_version())
 
     colr1, colr2 = st.columns([1, 3])
     with colr1:
@@ -352,21 +1059,30 @@ def page_view_stock():
     with colr2:
         st.caption("Tip: tick rows and click 'Add to Draft' to build a quote.")
 
-    # Build thumbnails once per render
-    thumb_dataurls, thumb_paths = [], []
-    for _, r in df.iterrows():
-        sku = (r["sku"] or "").strip() or hashlib.sha1(str(r.to_dict()).encode()).hexdigest()[:10]
-        durl, fpath = (None, None)
-        url = (r["image_url"] or "").strip()
-        if url:
-            durl, fpath = ensure_thumb_from_url(url, sku, refresh=refresh_thumbs)
-        thumb_dataurls.append(durl)
-        thumb_paths.append(fpath)
-    df.insert(1, "thumb", thumb_dataurls)
-    df.insert(2, "thumb_path", thumb_paths)
-
-    # Add checkbox column for selection
-    df.insert(0, "select", False)
+    # plain column arrays, no per-row Series
+    urls = df["image_url"].fillna("").str.strip()
+    tasks = list(zip(thumb_keys(df["sku"], urls), urls.values))
+    # grid paints straight away; misses render in the background and fill in on a follow-up rerun
+    held = st.session_state.pop("viewstock_thumbs", None)  # (tasks, thumbs) the grid showed last run
+    frozen = False
+    if refresh_thumbs:
+        thumbs, pending = build_thumbs(tasks, refresh=True), []
+    else:
+        thumbs, pending = start_thumbs(tasks)
+        # with num_rows="dynamic" the editor's widget id hashes its data: thumbs landing mid-edit would
+        # give it a new id and drop the user's ticks/edits, so keep the held thumbs until the grid is clean
+        frozen = held is not None and held[0] == tasks and _editor_dirty("viewstock_editor")
+        if frozen:
+            thumbs = held[1]
+    if pending or frozen:
+        st.session_state["viewstock_thumbs"] = (tasks, thumbs)
+    if pending:
+        _await_thumbs(pending)
+    df["thumb"] = [t[0] for t in thumbs]
+    df["thumb_path"] = [t[1] for t in thumbs]
+
+    # Add checkbox column for selection (display order comes from the column list below)
+    df["select"] = False
 
     edited = st.data_editor(
         df[["select", "thumb", "sku", "name", "category", "subcategory", "price", "stock", "image_url"]],
@@ -394,23 +1110,28 @@ def page_view_stock():
             if sel.empty:
                 st.info("No rows selected.")
             else:
-                draft_prev = st.session_state.get("draft_cart", pd.DataFrame(columns=["sku","name","price","qty","image_url","thumb_path"]))
-                add = sel[["sku","name","price","image_url","thumb_path"]].copy()
-                add["qty"] = 1
-                combined = pd.concat([draft_prev, add], ignore_index=True)
-                combined = combined.groupby(["sku","name","price","image_url","thumb_path"], dropna=False, as_index=False)["qty"].sum()
-                st.session_state["draft_cart"] = combined
+                add_to_draft(
+                    st.session_state["draft_cart"],
+                    # thumb_path is not an editor column: take it from the source frame (rows added in the grid have none)
+                    sel[["sku", "name", "price", "image_url"]]
+                    .assign(thumb_path=df["thumb_path"].reindex(sel.index), qty=1)
+                    .itertuples(index=False, name=None),
+                )
                 st.success(f"Added {len(sel)} item(s) to draft.")
     with cB:
         if st.button("💾 Save Changes", key="save_changes_viewstock"):
-            for _, r in edited.iterrows():
-                exec_sql(
-                    """
-                    UPDATE products SET name=?, category=?, subcategory=?, price=?, stock=?, image_url=? WHERE sku=?
-                    """,
-                    (r["name"], r["category"], r["subcategory"], float(r["price"] or 0), int(r["stock"] or 0), (r["image_url"] or None), r["sku"]),
-                )
-            st.success("Changes saved.")
+            cols = ["name", "category", "subcategory", "price", "stock", "image_url", "sku"]
+            # only rows whose values differ from what was loaded (NaN == NaN counts as unchanged)
+            common = edited.index.intersection(df.index)
+            new, old = edited.loc[common, cols], df.loc[common, cols]
+            changed = ((new != old) & ~(new.isna() & old.isna())).any(axis=1)
+            params = [
+                (name, category, subcategory, float(price or 0), int(stock or 0), (image_url or None), sku)
+                for name, category, subcategory, price, stock, image_url, sku
+                in new[changed].itertuples(index=False, name=None)
+            ]
+            exec_many(UPDATE_PRODUCT_SQL, params)
+            st.success(f"Saved {len(params)} changed row(s)." if params else "No changes to save.")
 
 
 # ---------- Add Stock ----------
@@ -456,17 +1177,7 @@ def page_add_stock():
             image_url_final = (image_url.strip() if image_url else None)
 
         exec_sql(
-            """
-            INSERT INTO products (sku, name, category, subcategory, price, image_url, stock)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            ON CONFLICT(sku) DO UPDATE SET
-              name=excluded.name,
-              category=excluded.category,
-              subcategory=excluded.subcategory,
-              price=excluded.price,
-              image_url=excluded.image_url,
-              stock=excluded.stock
-            """,
+            INSERT_PRODUCT_SQL,
             (sku.strip(), name.strip(), category.strip(), subcategory.strip(), float(price), image_url_final, int(stock))
         )
 
@@ -485,43 +1196,35 @@ def page_add_stock():
 def page_quote_builder():
     st.subheader("Quote Builder")
 
-    # Start with any draft items
-    draft = st.session_state.get("draft_cart", pd.DataFrame(columns=["sku","name","price","qty","image_url","thumb_path"]))
-
-    df = query_df("SELECT sku, name, price, image_url FROM products ORDER BY name")
-    pick = st.multiselect("Add more items", df["name"].tolist(), key="qb_add_more")
-    extra = pd.DataFrame(columns=["sku","name","price","qty","image_url","thumb_path"]) if not pick else (
-        df[df["name"].isin(pick)].copy().assign(qty=1)
+    version = get_data_version()
+    by_name = products_by_name(version)
+    # options straight from the cached name index (already in name order): no per-rerun column-to-list copy
+    pick = st.multiselect("Add more items", list(by_name), key="qb_add_more")
+    extra = pd.DataFrame(columns=DRAFT_COLUMNS) if not pick else (
+        pd.DataFrame([row for n in pick for row in by_name.get(n, ())], columns=["sku", "name", "price", "image_url"]).assign(qty=1)
     )
 
     # prepare thumbs for extra
     if not extra.empty:
-        tpaths = []
-        for _, r in extra.iterrows():
-            sku = (r["sku"] or "").strip() or hashlib.sha1(str(r.to_dict()).encode()).hexdigest()[:10]
-            _, tpath = ensure_thumb_from_url(r.get("image_url",""), f"{sku}_q")
-            tpaths.append(tpath)
-        extra["thumb_path"] = tpaths
-
-    # Combine draft + extra (by SKU)
-    all_rows = pd.concat([draft, extra], ignore_index=True)
-    if not all_rows.empty:
-        all_rows = all_rows.groupby(["sku","name","price","image_url","thumb_path"], dropna=False, as_index=False)["qty"].sum()
+        urls = extra["image_url"].fillna("")
+        tasks = [(f"{key}_q", url) for key, url in zip(thumb_keys(extra["sku"], urls), urls)]
+        extra["thumb_path"] = [tpath for _, tpath in build_thumbs(tasks, data_urls=False)]
+
+    # Combine draft + extra (by SKU); picks stay out of the saved draft until "Save Draft"
+    merged = {k: dict(line) for k, line in st.session_state["draft_cart"].items()}
+    if not extra.empty:
+        add_to_draft(merged, extra[["sku", "name", "price", "image_url", "thumb_path", "qty"]].itertuples(index=False, name=None))
+    all_rows = draft_frame(merged)
 
     if all_rows.empty:
         st.info("Draft is empty. Add items from View Stock or using the selector above.")
         return
 
     # Show editable cart with preview thumbs
-    show = all_rows.copy()
-    thumbs = []
-    for _, r in show.iterrows():
-        url = r.get("image_url") or ""
-        du, _ = (None, None)
-        if url:
-            du, _ = ensure_thumb_from_url(url, r.get("sku","preview"))
-        thumbs.append(du)
-    show.insert(0, "thumb", thumbs)
+    urls = all_rows["image_url"].fillna("")
+    tasks = list(zip(thumb_keys(all_rows["sku"], urls), urls))
+    # assign builds the new frame in one step; no defensive copy + insert
+    show = all_rows.assign(thumb=[du for du, _ in build_thumbs(tasks)])
 
     cart = st.data_editor(
         show[["thumb","sku","name","price","qty","image_url"]],
@@ -548,16 +1251,13 @@ def page_quote_builder():
     if st.button("📄 Generate PDF", key="generate_pdf_btn"):
         # Build dataframe with thumb_path for PDF
         pdf_df = cart.copy()
-        tpaths = []
-        for _, r in pdf_df.iterrows():
-            sku = (r["sku"] or "").strip() or hashlib.sha1(str(r.to_dict()).encode()).hexdigest()[:10]
-            _, tpath = ensure_thumb_from_url(r.get("image_url",""), f"{sku}_pdf")
-            tpaths.append(tpath)
-        pdf_df["thumb_path"] = tpaths
+        urls = pdf_df["image_url"].fillna("")
+        tasks = [(f"{key}_pdf", url) for key, url in zip(thumb_keys(pdf_df["sku"], urls), urls)]
+        pdf_df["thumb_path"] = [tpath for _, tpath in build_thumbs(tasks, data_urls=False)]
 
         meta = {"qno": qno, "name": cname, "company": comp, "phone": phone}
         try:
-            pdf_bytes = render_quote_pdf(meta, pdf_df)
+            pdf_bytes = quote_pdf_bytes(meta, pdf_df)
             st.session_state["last_pdf"] = (qno, pdf_bytes)
             st.success("PDF generated.")
         except Exception as e:
@@ -566,11 +1266,13 @@ def page_quote_builder():
     cA, cB = st.columns([1,1])
     with cA:
         if st.button("💾 Save Draft", key="save_draft_btn"):
-            st.session_state["draft_cart"] = cart[["sku","name","price","qty","image_url"]]
+            saved: Dict[str, dict] = {}
+            add_to_draft(saved, cart[["sku", "name", "price", "image_url"]].assign(thumb_path=None, qty=cart["qty"]).itertuples(index=False, name=None))
+            st.session_state["draft_cart"] = saved
             st.success("Draft saved.")
     with cB:
         if st.button("🧹 Clear Draft", key="clear_draft_btn"):
-            st.session_state["draft_cart"] = pd.DataFrame(columns=["sku","name","price","qty","image_url","thumb_path"])
+            st.session_state["draft_cart"] = {}
             st.success("Draft cleared.")
 
     if "last_pdf" in st.session_state:
@@ -586,9 +1288,14 @@ def page_quote_builder():
 
 # ---------- Quotes History ----------
 
+@st.cache_data(ttl=60, show_spinner=False)
+def load_quotes() -> pd.DataFrame:
+    # quotes are written outside this app (no data_version trigger covers them): the TTL bounds staleness
+    return query_df("SELECT id, qno, customer_name, company, phone, created_at FROM quotes ORDER BY id DESC")
+
+
 def page_quotes_history():
-    h = query_df("SELECT id, qno, customer_name, company, phone, created_at FROM quotes ORDER BY id DESC")
-    st.dataframe(h, width='stretch')
+    st.dataframe(load_quotes(), width='stretch')
 
 
 # ---------- Diagnostics ----------